@@ -26,6 +26,15 @@ import mmap
 import fnmatch
 import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+try:  # optional; faster JSON serialization for the output report
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_MAX_FILE_SIZE = 8 * 1024 * 1024
 
 
 class Config:
@@ -127,6 +136,12 @@ class Config:
                 "subtype": str,
                 "description": "List of patterns to exclude files; Unix shell-style wildcards; default=[]",
             },
+            {
+                "name": "max_file_size",
+                "default": DEFAULT_MAX_FILE_SIZE,
+                "type": int,
+                "description": "Files larger than this size, in bytes, are not searched; default=8388608 (8 MiB)",
+            },
         ]
 
     def __default():
@@ -142,35 +157,103 @@ class Config:
         print(json.dumps(self._config, sort_keys=True, indent=4))
 
 
-def get_all_files_in_directory(root_dir):
+def compile_patterns(patterns):
+    """
+    Fuses a list of Unix shell-style wildcards into a single compiled regex.
+    Returns None if the list is empty.
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join(f"(?:{fnmatch.translate(os.path.normcase(p))})" for p in patterns))
+
+
+def get_all_files_in_directory(root_dir, exclude_patterns=()):
+    """
+    Lazily yields the path of every regular file within root_dir that does not match 'exclude_patterns'.
+    Uses os.scandir so the file type comes from the directory entry, without an extra stat call per file.
+    """
+    # a directory is pruned if "<dir>/" matches a pattern ending with '*'; the trailing wildcard then
+    # matches every path below it, so no file within the subtree could be included
+    prune_re = compile_patterns([p for p in exclude_patterns if p.endswith('*')])
+    return _walk(root_dir, compile_patterns(exclude_patterns), prune_re)
+
+
+def _is_dir(entry):
+    try:
+        return entry.is_dir(follow_symlinks=False)
+    except OSError:  # e.g., the entry cannot be stat'ed; treated as not-a-dir, as os.walk does
+        return False
+
+
+def _is_file(entry):
+    try:
+        return entry.is_file()
+    except OSError:  # e.g., a symlink that cannot be stat'ed; treated as not-a-file
+        return False
+
+
+def _classify(entry, exclude_re, prune_re):
+    """
+    Returns "dir" for a subdirectory to walk into, "file" for a file to yield, or None if the entry is skipped.
     """
+    if _is_dir(entry):
+        if prune_re and prune_re.match(os.path.normcase(entry.path + os.sep)):
+            return None
+        return "dir"
+    if _is_file(entry):
+        if exclude_re and exclude_re.match(os.path.normcase(entry.path)):
+            return None
+        return "file"
+    return None
+
+
+def _walk(root_dir, exclude_re, prune_re):
+    try:
+        entries = os.scandir(root_dir)
+    except OSError:  # unreadable directory; skipped, as os.walk does
+        return
+    subdirs = []
+    with entries:
+        try:
+            for entry in entries:
+                kind = _classify(entry, exclude_re, prune_re)
+                if kind == "dir":
+                    subdirs.append(entry.path)
+                elif kind == "file":
+                    yield entry.path
+        except OSError:  # reading the directory failed midway; keep what was listed so far
+            pass
+    for subdir in subdirs:
+        yield from _walk(subdir, exclude_re, prune_re)
+
+
+def filter_files_of_interest(file_list, include_patterns):
     """
-    file_list = []
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            file_list.append(file_path)
-    return file_list
+    Lazily yields the files from file_list that match 'include_patterns'.
+    """
+    include_re = compile_patterns(include_patterns)
+    if include_re is None:
+        return
+    for f in file_list:
+        if include_re.match(os.path.normcase(f)):
+            yield f
 
 
-def filter_files_of_interest(file_list, include_patterns, exclude_patterns):
+def format_location(location: tuple) -> str:
     """
+    Formats a (file, line, column) location as "file:line:column".
     """
-    filtered_files = [f for f in file_list if os.path.isfile(f)]
-    # filter for files that match 'include_patterns'
-    filtered_files = [f for f in file_list if any(
-        fnmatch.fnmatch(f, pattern) for pattern in include_patterns)]
-    # remove the files that match 'exclude_patterns'
-    filtered_files = [f for f in filtered_files if not any(
-        fnmatch.fnmatch(f, pattern) for pattern in exclude_patterns)]
-    return filtered_files
+    return "%s:%d:%d" % location
 
 
 class TagResults:
-    def __init__(self, id: str):
-        self.id = id
-        self.claims: list[str] = []
-        self.proofs: list[str] = []
+    __slots__ = ("id", "claims", "proofs")
+
+    def __init__(self, id: bytes):
+        self.id = id  # raw tag id; decoded only when reported
+        # (file, line, column) locations; formatted only when reported
+        self.claims: list[tuple] = []
+        self.proofs: list[tuple] = []
 
     def create_error_logs(self):
         def red(text):
@@ -191,11 +274,17 @@ class TagResults:
             warning += yellow(" WARN") + f": multiple proofs with same id;\n"
         occurrences_log = ""
         for claim in self.claims:
-            occurrences_log += f"\tClaim @ {claim}\n"
+            occurrences_log += f"\tClaim @ {format_location(claim)}\n"
         for proof in self.proofs:
-            occurrences_log += f"\tProof @ {proof}\n"
+            occurrences_log += f"\tProof @ {format_location(proof)}\n"
         return error, warning, occurrences_log
 
+    def status(self):
+        """
+        Returns (has_error, has_warning) without building the log messages.
+        """
+        return self.is_incomplete(), len(self.claims) > 1 or len(self.proofs) > 1
+
     def is_incomplete(self):
         if not self.claims:
             return True
@@ -205,76 +294,175 @@ class TagResults:
 
 
 class Occurrence:
-    def __init__(self, id: str, file: str, position: str):
+    __slots__ = ("id", "file", "position")
+
+    def __init__(self, id: bytes, file: str, position: tuple):
         self.id = id
         self.file = file
         self.position = position
 
 
-class REMatcher:
+_MMAP_THRESHOLD = 64 * 1024  # files smaller than this are read instead of mapped
+_STREAM_THRESHOLD = 16 * 1024 * 1024  # files larger than this are read in chunks instead of mapped
+_STREAM_CHUNK_SIZE = 1024 * 1024
+_STREAM_CARRY_SIZE = 512  # tail carried over between chunks so tags spanning a boundary are found
 
-    def __init__(self):
-        self.claim_pattern = re.compile(r'@claim{([^}]*)}'.encode())
-        self.proof_pattern = re.compile(r'@proof{([^}]*)}'.encode())
 
-    def match(self, file_list):
-        claim_matches = self.__find_all_occurrences(
-            file_list, self.claim_pattern)
-        proof_matches = self.__find_all_occurrences(
-            file_list, self.proof_pattern)
-        return self.__create_results_map(claim_matches, proof_matches)
+def _count_lines(buf, start: int, end: int, line_number: int, newline_offset: int):
+    """
+    Advances the line count over the newlines within buf[start:end].
+    newline_offset is the offset of the last newline seen so far; -1 if none.
+    Returns the updated (line_number, newline_offset).
+    """
+    # slicing also makes mmap'ed data countable; each byte is touched at most once per sweep
+    segment = buf[start:end]
+    newlines = segment.count(b'\n')
+    if newlines:
+        line_number += newlines
+        newline_offset = start + segment.rfind(b'\n')
+    return line_number, newline_offset
 
-    def __find_occurrences_in_file(self, pattern: re.Pattern, filepath: str) -> list[Occurrence]:
-        """
-        """
 
-        if os.path.getsize(filepath) == 0:  # empty file
+def _scan_file(filepath: str, pattern: re.Pattern, max_file_size: int):
+    """
+    Scans a single file for tag occurrences; runs in a worker process.
+    Empty, oversized (> max_file_size bytes) and binary files are skipped.
+    Returns a list of (kind, Occurrence) tuples, where kind is the tag type, i.e., b'claim' or b'proof'.
+    """
+
+    file_size = os.stat(filepath).st_size
+    if file_size == 0 or file_size > max_file_size:
+        return []
+
+    with open(filepath, 'rb') as f:
+        # in both branches, a NUL byte within the first block flags a binary file
+        if file_size < _MMAP_THRESHOLD:  # small files are read at once; cheaper than setting up a mapping
+            buf = f.read()
+            if buf.find(b'\x00', 0, 4096) >= 0:
+                return []
+            return _scan_buffer(buf, pattern, filepath)
+        if b'\x00' in f.read(4096):
             return []
+        if file_size > _STREAM_THRESHOLD:
+            f.seek(0)
+            return _scan_chunks(f, pattern, filepath)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-        with open(filepath, 'r') as f:
-            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mm:
+        try:  # hint the kernel to read ahead aggressively; not available on every platform
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        return _scan_buffer(mm, pattern, filepath)
 
-        matches = list(pattern.finditer(mm))
-        if not matches:
-            return []
 
-        last_match = matches[-1].start()
-        newline_map = {-1: 1}  # -1 so a failed 'rfind' maps to the first line.
-        newline_re = re.compile(b'\n')
-        for line_number, newline_match in enumerate(newline_re.finditer(mm), 2):
-            offset = newline_match.start()
-            if offset > last_match:  # stop at last match
+def _scan_buffer(buf, pattern: re.Pattern, filepath: str):
+    """
+    Scans the whole content of a file, either bytes or mmap, for tag occurrences.
+    """
+    # cheap substring prefilter; most files have no tags and skip the regex engine altogether
+    first_tag = [offset for offset in (buf.find(b'@claim{'), buf.find(b'@proof{')) if offset >= 0]
+    if not first_tag:
+        return []
+
+    # single forward sweep over the newlines; matches are ordered by offset
+    line_number = 1
+    newline_offset = -1
+    cursor = 0
+    occurrences = []
+    # the regex starts at the first tag prefix; the tag-free head of the file is only swept for newlines
+    for m in pattern.finditer(buf, min(first_tag)):
+        line_number, newline_offset = _count_lines(buf, cursor, m.start(), line_number, newline_offset)
+        cursor = m.start()
+        column = m.start() - max(0, newline_offset)
+        occurrences.append((m.group(1), Occurrence(
+            m.group(2), filepath, (line_number, column))))
+    return occurrences
+
+
+def _scan_chunks(f, pattern: re.Pattern, filepath: str,
+                 chunk_size: int = _STREAM_CHUNK_SIZE, carry_size: int = _STREAM_CARRY_SIZE):
+    """
+    Same as _scan_buffer, but reads the open file f in chunks of chunk_size bytes to bound memory usage.
+    The last carry_size bytes of a chunk are rescanned with the next one; tags longer than that
+    and split by a chunk boundary are not found.
+    """
+    line_number = 1
+    newline_offset = -1  # absolute file offset
+    base = 0  # absolute file offset of buf[0]
+    carry = b''
+    occurrences = []
+    while True:
+        chunk = f.read(chunk_size)
+        buf = carry + chunk
+        # matches starting in the tail are left for the next chunk, unless this is the last one
+        limit = len(buf) - carry_size if chunk else len(buf)
+        cursor = 0
+        consumed = max(0, limit)
+        for m in pattern.finditer(buf):
+            if m.start() >= limit:
                 break
-            newline_map[offset] = line_number
+            line_number, relative_offset = _count_lines(
+                buf, cursor, m.start(), line_number, newline_offset - base)
+            newline_offset = relative_offset + base
+            cursor = m.start()
+            column = base + m.start() - max(0, newline_offset)
+            occurrences.append((m.group(1), Occurrence(
+                m.group(2), filepath, (line_number, column))))
+            consumed = max(consumed, m.end())
+        line_number, relative_offset = _count_lines(
+            buf, cursor, consumed, line_number, newline_offset - base)
+        newline_offset = relative_offset + base
+        if not chunk:
+            return occurrences
+        carry = buf[consumed:]
+        base += consumed
 
-        for m in matches:
-            # failure -> -1 maps to line 1.
-            newline_offset = mm.rfind(b'\n', 0, m.start())
-            line_number = newline_map[newline_offset]
-            column = m.start() - max(0, newline_offset)
-            yield Occurrence(m.group(1).decode(), filepath, f"{line_number}:{column}")
 
-    def __find_all_occurrences(self, file_list, pattern) -> list[Occurrence]:
+class REMatcher:
+
+    def __init__(self, max_file_size: int = DEFAULT_MAX_FILE_SIZE):
+        self.tag_pattern = re.compile(rb'@(claim|proof){([^}]*)}')
+        self.max_file_size = max_file_size
+
+    def match(self, file_list):
         """
+        Scans the files of file_list, which may be a lazy iterable; files are handed to the workers
+        as they are produced, so scanning overlaps with the directory traversal.
+        Returns a tuple (results_map, number of scanned files).
         """
-        occurrences = []
-        for filepath in file_list:
-            occurrences += self.__find_occurrences_in_file(pattern, filepath)
-        return occurrences
-
-    def __create_results_map(self, claim_matches, proof_matches):
+        # compiled patterns are pickled by source and re-compiled (cached) in the workers
+        with ProcessPoolExecutor() as executor:
+            per_file_occurrences = executor.map(_scan_file, file_list,
+                                                repeat(self.tag_pattern), repeat(self.max_file_size),
+                                                chunksize=32)
+            return self.__create_results_map(per_file_occurrences)
+
+    def __create_results_map(self, per_file_occurrences):
+        # per-file results are consumed lazily; no combined list of all occurrences is built.
+        # ids are ordered as if all claims were collected before all proofs: claimed ids by first
+        # claim, then unclaimed ids by first proof; ids seen so far only in proofs wait in 'unclaimed'
         results_map = {}
-        for match in claim_matches:
-            id = match.id
-            if id not in results_map.keys():
-                results_map[id] = TagResults(id)
-            results_map[id].claims.append(f"{match.file}:{match.position}")
-        for match in proof_matches:
-            id = match.id
-            if id not in results_map.keys():
-                results_map[id] = TagResults(id)
-            results_map[id].proofs.append(f"{match.file}:{match.position}")
-        return results_map
+        unclaimed = {}
+        scanned_files = 0
+        for occurrences in per_file_occurrences:
+            scanned_files += 1
+            for kind, match in occurrences:
+                location = (match.file, *match.position)
+                tag_results = results_map.get(match.id)
+                if kind == b'claim':
+                    if tag_results is None:
+                        tag_results = unclaimed.pop(match.id, None) or TagResults(match.id)
+                        results_map[match.id] = tag_results
+                    tag_results.claims.append(location)
+                else:
+                    if tag_results is None:
+                        tag_results = unclaimed.get(match.id)
+                        if tag_results is None:
+                            tag_results = unclaimed[match.id] = TagResults(match.id)
+                    tag_results.proofs.append(location)
+        results_map.update(unclaimed)
+        return results_map, scanned_files
 
 
 def log_results(results_map: dict):
@@ -282,29 +470,56 @@ def log_results(results_map: dict):
         error, warn, occurrences_log = tag_results.create_error_logs()
         if error != "" or warn != "":
             print(error + warn, end="")
-            print("\tTag id: ", id)
+            # backslashreplace keeps distinct invalid UTF-8 ids distinct and printable
+            print("\tTag id: ", id.decode("utf-8", "backslashreplace"))
             print(occurrences_log)
 
 
+def _dump_json(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:  # e.g., file names that are not valid UTF-8 (surrogate-escaped str)
+            pass
+    # ensure_ascii escapes lone surrogates, so any str can be serialized
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
 def create_report(results_map: dict, filepath: str):
     if filepath:
-        out = {"number_tags": len(results_map),
-               "error_tags": [], "warn_tags": []}
+        tags = []
+        error_tags = []
+        warn_tags = []
         for id, tag_results in results_map.items():
-            error, warn, _ = tag_results.create_error_logs()
-            out[id] = {
-                "claims": tag_results.claims,
-                "proofs": tag_results.proofs,
-            }
-            if error != "":
-                out["error_tags"].append(id)
-            if warn != "":
-                out["warn_tags"].append(warn)
+            # surrogateescape keeps distinct invalid UTF-8 ids distinct, as it does for file names
+            id = id.decode("utf-8", "surrogateescape")
+            tags.append((id, tag_results))
+            has_error, has_warning = tag_results.status()
+            if has_error:
+                error_tags.append(id)
+            if has_warning:
+                warn_tags.append(id)
 
         print(f"== Writing output report @ {filepath}")
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w') as f:
-            json.dump(out, f)
+        # the report is streamed one tag at a time into a temporary file, which then replaces
+        # 'filepath'; a failure midway cannot leave a partial report behind
+        tmp_filepath = filepath + ".tmp"
+        try:
+            with open(tmp_filepath, 'wb') as f:
+                f.write(b'{"number_tags":%d,"error_tags":%s,"warn_tags":%s' % (
+                    len(results_map), _dump_json(error_tags), _dump_json(warn_tags)))
+                for id, tag_results in tags:
+                    f.write(b',%s:%s' % (_dump_json(id), _dump_json({
+                        "claims": [format_location(claim) for claim in tag_results.claims],
+                        "proofs": [format_location(proof) for proof in tag_results.proofs],
+                    })))
+                f.write(b'}')
+            os.replace(tmp_filepath, filepath)
+        except BaseException:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
 
 
 def run():
@@ -315,19 +530,20 @@ def run():
     config.print()
     print()
 
-    file_list = get_all_files_in_directory(config.at("directory"))
-    file_list = filter_files_of_interest(
-        file_list, config.at("include_pattern"), config.at("exclude_pattern"))
+    # lazily walk and filter; the matcher starts scanning while the traversal is ongoing
+    file_list = get_all_files_in_directory(
+        config.at("directory"), config.at("exclude_pattern"))
+    file_list = filter_files_of_interest(file_list, config.at("include_pattern"))
 
     # TODO: on debug mode, print(file_list)
 
-    matcher = REMatcher()
-    results_map = matcher.match(file_list)
+    matcher = REMatcher(config.at("max_file_size"))
+    results_map, scanned_files = matcher.match(file_list)
 
     log_results(results_map)
     create_report(results_map, config.at("output_report"))
 
-    print(f"== {len(file_list)} files scanned, {len(results_map)} tag ids found.")
+    print(f"== {scanned_files} files scanned, {len(results_map)} tag ids found.")
     for res in results_map.values():
         if res.is_incomplete():
             return 1
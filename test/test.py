@@ -1,6 +1,11 @@
+import contextlib
+import io
 import unittest
+import unittest.mock
+import json
 import os
 import sys
+import tempfile
 
 import provable_claims
 
@@ -25,6 +30,12 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(len(config.at("exclude_pattern")), 1)
         self.assertEqual(config.at("exclude_pattern")[0], "<none>")
 
+    def test_max_file_size_from_cli(self):
+        config = init_config(
+            ["provable_claims.py", "--config_path", TEST_DIR+".config",
+             "--max_file_size", "1024"])
+        self.assertEqual(config.at("max_file_size"), 1024)
+
 
 class TestScript(unittest.TestCase):
     def test_all_match(self):
@@ -37,6 +48,165 @@ class TestScript(unittest.TestCase):
             ["provable_claims.py", "--config_path", TEST_DIR+".config_error"])
         self.assertEqual(provable_claims.run(), 1)
 
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, "report.json")
+            config = init_config(
+                ["provable_claims.py", "--config_path", TEST_DIR+".config_error",
+                 "--output_report", report_path])
+            self.assertEqual(provable_claims.run(), 1)
+            with open(report_path) as f:
+                report = json.load(f)
+        self.assertEqual(sorted(report["error_tags"]), ["unclaimed", "unproved"])
+        self.assertEqual(report["warn_tags"], ["doc_warn/duplicated"])
+        self.assertEqual(report["unproved"], {"claims": ["test/test_files/doc_error.md:1:0"], "proofs": []})
+
+    def test_report_non_utf8_ids(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "ids.md"), 'wb') as f:
+                # tags are formatted so the tool does not pick up this source file itself
+                f.write(b"@%s{a\xff}\n@%s{a\xfe}\n" % (b"claim", b"claim"))
+            report_path = os.path.join(tmp_dir, "out", "report.json")
+            config = init_config(
+                ["provable_claims.py", "--config_path", TEST_DIR+".config",
+                 "--directory", tmp_dir, "--output_report", report_path])
+            log = io.StringIO()
+            with contextlib.redirect_stdout(log):
+                self.assertEqual(provable_claims.run(), 1)
+            with open(report_path) as f:
+                report = json.load(f)
+        self.assertEqual(report["number_tags"], 2)
+        self.assertEqual(report["error_tags"], ["a\udcff", "a\udcfe"])
+        self.assertEqual(report["a\udcff"]["claims"], [os.path.join(tmp_dir, "ids.md") + ":1:0"])
+        self.assertEqual(report["a\udcfe"]["claims"], [os.path.join(tmp_dir, "ids.md") + ":2:1"])
+        self.assertIn("Tag id:  a\\xff\n", log.getvalue())
+        self.assertIn("Tag id:  a\\xfe\n", log.getvalue())
+
+    def test_report_failure_leaves_no_partial_report(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, "report.json")
+            with open(report_path, 'w') as f:
+                f.write("previous report")
+            config = init_config(
+                ["provable_claims.py", "--config_path", TEST_DIR+".config",
+                 "--output_report", report_path])
+            dump_json = provable_claims.provable_claims._dump_json
+            # fail while writing the tags, after the report header was written
+            with unittest.mock.patch("provable_claims.provable_claims._dump_json",
+                                     side_effect=[dump_json([]), dump_json([]), ValueError]):
+                with self.assertRaises(ValueError):
+                    provable_claims.run()
+            self.assertEqual(os.listdir(tmp_dir), ["report.json"])
+            with open(report_path) as f:
+                self.assertEqual(f.read(), "previous report")
+
+    def assertReportWithNonUtf8FileName(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(os.fsencode(tmp_dir), b"f\xff.md"), 'wb') as f:
+                # tags are formatted so the tool does not pick up this source file itself
+                f.write(b"@%s{non_utf8}\n@%s{non_utf8}\n" % (b"claim", b"proof"))
+            report_path = os.path.join(tmp_dir, "out", "report.json")
+            config = init_config(
+                ["provable_claims.py", "--config_path", TEST_DIR+".config",
+                 "--directory", tmp_dir, "--output_report", report_path])
+            self.assertEqual(provable_claims.run(), 0)
+            with open(report_path) as f:
+                report = json.load(f)
+        file_name = os.path.join(tmp_dir, "f\udcff.md")
+        self.assertEqual(report["non_utf8"], {"claims": [file_name + ":1:0"], "proofs": [file_name + ":2:1"]})
+
+    @unittest.skipIf(provable_claims.provable_claims.orjson is None, "orjson is not installed")
+    def test_report_non_utf8_file_name_orjson(self):
+        self.assertReportWithNonUtf8FileName()
+
+    def test_report_non_utf8_file_name_json(self):
+        with unittest.mock.patch("provable_claims.provable_claims.orjson", None):
+            self.assertReportWithNonUtf8FileName()
+
+    def test_oversized_files_skipped(self):
+        config = init_config(
+            ["provable_claims.py", "--config_path", TEST_DIR+".config_error",
+             "--max_file_size", "16"])
+        self.assertEqual(provable_claims.run(), 0)
+
+
+class TestFiles(unittest.TestCase):
+    def test_exclude_patterns(self):
+        files = list(provable_claims.provable_claims.get_all_files_in_directory(
+            TEST_DIR, ["**/excluded.md"]))
+        self.assertIn(TEST_DIR + "test_files/doc.md", files)
+        self.assertNotIn(TEST_DIR + "test_files/excluded.md", files)
+
+    def test_excluded_directory_pruned(self):
+        # the excluded directory itself must never be listed, not only have its files filtered out
+        with unittest.mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            files = list(provable_claims.provable_claims.get_all_files_in_directory(
+                TEST_DIR, ["**/test_files/**"]))
+        self.assertIn(TEST_DIR + "test.py", files)
+        self.assertFalse(any("test_files" in f for f in files))
+        scanned_dirs = [call.args[0] for call in scandir.call_args_list]
+        self.assertIn(TEST_DIR, scanned_dirs)
+        self.assertFalse(any("test_files" in d for d in scanned_dirs))
+
+    def test_entry_stat_error_skips_only_that_entry(self):
+        real_scandir = os.scandir
+
+        class UnstatableEntry:
+            path = TEST_DIR + "unstatable"
+
+            def is_dir(self, follow_symlinks=True):
+                raise PermissionError
+
+            def is_file(self, follow_symlinks=True):
+                raise PermissionError
+
+        class Entries(list):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        def scandir(path):
+            with real_scandir(path) as it:
+                entries = Entries(it)
+            if os.path.realpath(path) == os.path.realpath(TEST_DIR):
+                entries.insert(0, UnstatableEntry())
+            return entries
+
+        with unittest.mock.patch("os.scandir", scandir):
+            files = list(provable_claims.provable_claims.get_all_files_in_directory(TEST_DIR))
+        self.assertIn(TEST_DIR + "test.py", files)
+        self.assertIn(TEST_DIR + "test_files/doc.md", files)
+        self.assertNotIn(TEST_DIR + "unstatable", files)
+
+
+class TestScanner(unittest.TestCase):
+    def assertChunkedScanMatches(self, filepath):
+        pattern = provable_claims.provable_claims.REMatcher().tag_pattern
+        whole = provable_claims.provable_claims._scan_file(filepath, pattern, 1024 * 1024)
+        self.assertTrue(whole)
+        for chunk_size in [1, 7, 64, 4096]:
+            with open(filepath, 'rb') as f:
+                chunked = provable_claims.provable_claims._scan_chunks(
+                    f, pattern, filepath, chunk_size=chunk_size, carry_size=64)
+            self.assertEqual([(k, o.id, o.position) for k, o in chunked],
+                             [(k, o.id, o.position) for k, o in whole])
+
+    def test_chunked_scan_matches_read_scan(self):
+        for filename in ["MyClass.cpp", "MyClass.hpp", "doc.md", "doc_error.md"]:
+            self.assertChunkedScanMatches(TEST_DIR + "test_files/" + filename)
+
+    def test_chunked_scan_matches_mapped_scan(self):
+        # large enough to be mapped instead of read
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepath = os.path.join(tmp_dir, "large.md")
+            with open(filepath, 'wb') as f:
+                for i in range(4096):
+                    # tags are formatted so the tool does not pick up this source file itself
+                    f.write(b"filler line\n" * 4 + b"@%s{id_%d} @%s{id_%d}\n" % (b"claim", i, b"proof", i))
+            self.assertChunkedScanMatches(filepath)
+
 
 if __name__ == '__main__':
     unittest.main()